@@ -13,12 +13,113 @@ Contact: nathedd@unc.edu
 
 from astropy.io import ascii  # for reading files
 from astropy.table import Table  # for outputting results
+from concurrent.futures import ProcessPoolExecutor  # for stacking one light curve on several cores
+from multiprocessing import shared_memory  # lets workers read the epoch arrays without copying them
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 
 
-def stack_lc(tbl, days_stack): 
-    """Given a dataframe with a maxlike light curve, stack the flux."""
+def _stack_chunk(shm_specs, n_epochs, zpavg, n_filters, lower, edges):
+    """Stack the epochs falling in one contiguous run of bins (runs in a worker process)."""
+    shms = [shared_memory.SharedMemory(name=name) for name, _ in shm_specs]
+    try:
+        jd, code, flux, unc, zpdiff = [np.ndarray(n_epochs, dtype=dtype, buffer=shm.buf)
+                                       for shm, (_, dtype) in zip(shms, shm_specs)]
+
+        # epochs covered by this run of bins; jd is time-sorted so they are contiguous
+        lo = 0 if lower is None else np.searchsorted(jd, lower, side='right')
+        ends = np.searchsorted(jd, edges, side='right')  # end index (exclusive) of every bin
+        hi = ends[-1]
+
+        # place the fluxes on the same photometric zeropoint
+        rs_flux = flux[lo:hi]*10**(0.4 * (zpavg-zpdiff[lo:hi]))  # rescale the flux
+        rs_unc = unc[lo:hi]*10**(0.4 * (zpavg-zpdiff[lo:hi]))  # rescale the corresponding uncertainty
+        code = code[lo:hi]
+
+        # per-(filter, bin) sums of the weights and the weighted fluxes
+        w_sum = np.zeros((n_filters, len(edges)))
+        wf_sum = np.zeros((n_filters, len(edges)))
+        valid = np.zeros((n_filters, len(edges)), dtype=bool)
+        start = 0
+        for j in range(0, len(edges)):
+            end = ends[j] - lo
+            for i in range(0, n_filters):
+                in_bin = code[start:end] == i  # same indices, in the same order, as the serial path
+                w = 1/(rs_unc[start:end][in_bin])**2
+                w_sum[i, j] = np.nansum(w)
+                if w.size > 0 and w_sum[i, j] != 0:
+                    wf_sum[i, j] = np.nansum(w*rs_flux[start:end][in_bin])
+                    valid[i, j] = True
+            start = end
+        return w_sum, wf_sum, valid
+    finally:
+        for shm in shms:
+            shm.close()
+
+
+def _stack_parallel(tbl, jd, bins, zpavg, n_workers):
+    """Stack a time-sorted light curve by splitting its bins across worker processes. Returns bin_flux, bin_unc and filters as built by the serial path in stack_lc."""
+    n_epochs = len(jd)
+    bin_len = len(bins)
+
+    # numeric copies of the columns, with nan wherever the flux is null
+    raw_flux = np.asarray(tbl['forcediffimflux,'])
+    null = (raw_flux == 'null') if raw_flux.dtype.kind in 'US' else np.zeros(n_epochs, dtype=bool)
+    flux = np.full(n_epochs, np.nan)
+    unc = np.full(n_epochs, np.nan)
+    flux[~null] = raw_flux[~null].astype(np.float64)
+    unc[~null] = np.asarray(tbl['forcediffimfluxunc,'])[~null].astype(np.float64)
+    zpdiff = np.asarray(tbl['zpdiff,']).astype(np.float64)
+
+    # encode each filter by its order of first appearance, matching the serial path
+    fil = np.asarray(tbl['filter,'])
+    uniq, first, inverse = np.unique(fil, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    filters = list(uniq[order])
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    code = rank[inverse.ravel()]
+
+    # split the bins into runs holding roughly the same number of epochs
+    ends = np.searchsorted(jd, bins, side='right')
+    cuts = np.searchsorted(ends, n_epochs*np.arange(1, n_workers)/n_workers)
+    bounds = np.unique(np.concatenate(([0], cuts, [bin_len])))
+
+    shms = []
+    try:
+        for arr in (jd, code, flux, unc, zpdiff):
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            shms.append(shm)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        shm_specs = [(shm.name, arr.dtype) for shm, arr in zip(shms, (jd, code, flux, unc, zpdiff))]
+
+        with ProcessPoolExecutor(max_workers=len(bounds) - 1) as pool:
+            futures = [pool.submit(_stack_chunk, shm_specs, n_epochs, zpavg, len(filters),
+                                   bins[a-1] if a > 0 else None, bins[a:b])
+                       for a, b in zip(bounds[:-1], bounds[1:])]
+            results = [future.result() for future in futures]
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    # merge the per-(filter, bin) sums; runs end on bin edges so each bin comes from exactly one worker
+    bin_flux = np.zeros((bin_len, 2))
+    bin_unc = np.zeros((bin_len, 2))
+    for a, (w_sum, wf_sum, valid) in zip(bounds[:-1], results):
+        for j in range(0, w_sum.shape[1]):
+            for i in range(0, len(filters)):
+                if valid[i, j]:  # later filters overwrite earlier ones, as in the serial path
+                    bin_flux[a+j, 0] = wf_sum[i, j]/w_sum[i, j]
+                    bin_unc[a+j, 0] = w_sum[i, j]**(-1/2)  # combined unc
+                    bin_flux[a+j, 1] = i  # filter
+                    bin_unc[a+j, 1] = i  # filter
+    return bin_flux, bin_unc, filters
+
+
+def stack_lc(tbl, days_stack, n_workers=1): 
+    """Given a dataframe with a maxlike light curve, stack the flux. If n_workers > 1 (None uses every core) and the epochs are time-sorted, the bins are stacked in parallel; the result is identical to the serial path."""
     snt_det=3  # signal to noise threshold for declaring a measurement a "non-detection"
     snt_ul=5  # actual signal to noise ratio for computing a sigma upper limit
 
@@ -38,42 +139,47 @@ def stack_lc(tbl, days_stack):
     bin_len = len(bins)
 
 
-    # place the fluxes on the same photometric zeropoint
-    rs_flux = np.zeros(length+1)  # variable for rescaled fluxes
-    rs_unc = np.zeros(length+1)  # variable for rescaled flux uncertainties
-
-    for index in range (0, length + 1):
-        if (tbl['forcediffimflux,'][index]) != 'null':
-            flux_i = np.copy(tbl['forcediffimflux,'][index]).astype(np.float64)  # old forcediffimflux value
-            unc_i = np.copy(tbl['forcediffimfluxunc,'][index]).astype(np.float64)  # old forcediffimfluxunc value
-            zpdiff_i = np.copy(tbl['zpdiff,'][index]).astype(np.float64)
-            rs_flux[index] = flux_i*10**(0.4 * (zpavg-zpdiff_i))  # rescale the flux
-            rs_unc[index] = unc_i*10**(0.4 * (zpavg-zpdiff_i))  # rescale the corresponding uncertainty
-        else:
-            rs_flux[index] = np.nan
-            rs_unc[index] = np.nan
-
-    # combine flux measurements by filter
-    filters = list(dict.fromkeys(fil))  # fetches each unique filter
-    bin_flux = np.zeros((bin_len, 2))
-    bin_unc = np.zeros((bin_len, 2))
-    for i in range(0, len(filters)):
-        f_idx = np.where(fil==filters[i])[0]  # get all indices for a particular filter
-        for j in range(0, bin_len):
-            new_idx = np.copy(f_idx)
-            bin_idx = np.where(jd[new_idx] <= bins[j])[0]  # get valid lower limit indices in jd_bin
-            if bin_idx.size != 0:
-                new_idx = new_idx[bin_idx]
-                if j != 0 and new_idx.size != 0:
-                    bin_idx = np.where(jd[new_idx] > bins[j-1])[0]  # get valid upper limit indices in jd_bin
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers > 1 and bin_len > 1 and np.all(np.diff(jd) >= 0):
+        bin_flux, bin_unc, filters = _stack_parallel(tbl, jd, bins, zpavg, n_workers)
+    else:
+        # place the fluxes on the same photometric zeropoint
+        rs_flux = np.zeros(length+1)  # variable for rescaled fluxes
+        rs_unc = np.zeros(length+1)  # variable for rescaled flux uncertainties
+
+        for index in range (0, length + 1):
+            if (tbl['forcediffimflux,'][index]) != 'null':
+                flux_i = np.copy(tbl['forcediffimflux,'][index]).astype(np.float64)  # old forcediffimflux value
+                unc_i = np.copy(tbl['forcediffimfluxunc,'][index]).astype(np.float64)  # old forcediffimfluxunc value
+                zpdiff_i = np.copy(tbl['zpdiff,'][index]).astype(np.float64)
+                rs_flux[index] = flux_i*10**(0.4 * (zpavg-zpdiff_i))  # rescale the flux
+                rs_unc[index] = unc_i*10**(0.4 * (zpavg-zpdiff_i))  # rescale the corresponding uncertainty
+            else:
+                rs_flux[index] = np.nan
+                rs_unc[index] = np.nan
+
+        # combine flux measurements by filter
+        filters = list(dict.fromkeys(fil))  # fetches each unique filter
+        bin_flux = np.zeros((bin_len, 2))
+        bin_unc = np.zeros((bin_len, 2))
+        for i in range(0, len(filters)):
+            f_idx = np.where(fil==filters[i])[0]  # get all indices for a particular filter
+            for j in range(0, bin_len):
+                new_idx = np.copy(f_idx)
+                bin_idx = np.where(jd[new_idx] <= bins[j])[0]  # get valid lower limit indices in jd_bin
+                if bin_idx.size != 0:
                     new_idx = new_idx[bin_idx]
-                w = 1/(rs_unc[new_idx])**2
-                w_sum = np.nansum(w)  # prevents RuntimeWarning with scalar divide/scalar power
-                if w.size > 0 and w_sum != 0:
-                    bin_flux[j, 0] = np.nansum(w*rs_flux[new_idx])/w_sum
-                    bin_unc[j, 0] = np.nansum(w)**(-1/2)  # combined unc
-                    bin_flux[j, 1] = i  # filter
-                    bin_unc[j, 1] = i  # filter
+                    if j != 0 and new_idx.size != 0:
+                        bin_idx = np.where(jd[new_idx] > bins[j-1])[0]  # get valid upper limit indices in jd_bin
+                        new_idx = new_idx[bin_idx]
+                    w = 1/(rs_unc[new_idx])**2
+                    w_sum = np.nansum(w)  # prevents RuntimeWarning with scalar divide/scalar power
+                    if w.size > 0 and w_sum != 0:
+                        bin_flux[j, 0] = np.nansum(w*rs_flux[new_idx])/w_sum
+                        bin_unc[j, 0] = np.nansum(w)**(-1/2)  # combined unc
+                        bin_flux[j, 1] = i  # filter
+                        bin_unc[j, 1] = i  # filter
     
     # calculate calibrated magnitudes
     mag = np.zeros(bin_len)